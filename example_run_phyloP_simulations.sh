@@ -21,3 +21,20 @@ while read line; do
 done < mirnas_7_12_intra_less_exonic.bed
 
 
+
+
+# The same Random Flanking simulation split in 100 independent shards, which
+# can run as a cluster array job (e.g. SGE_TASK_ID / SLURM_ARRAY_TASK_ID).
+# 1) plan: write shard manifests to shards/
+python simulation_features.py plan -i mirnas_7_12_inter.bed -b \
+ensembl71_protein_coding_exons.bed -d bed_files/ \
+-rf -n 100 -N 100 --seed 1 -o shards/
+
+# 2) run-shard: one task per manifest (here, a sequential loop)
+for manifest in shards/shard_*.json; do
+    python simulation_features.py run-shard $manifest -o ${manifest%.json}.out
+done
+
+# 3) merge: combine shard outputs in input order
+python simulation_features.py merge shards/shard_*.out \
+> mirnas_7_12_inter_phylop_flank_rf100.txt
@@ -30,7 +30,11 @@ from pybedtools import BedTool
 from libtools import(read_features,
                      get_regions,
                      calculate_mean_score,
+                     calculate_scores,
+                     combine_flanking_scores,
                      run_bedextract,
+                     cached_bedextract,
+                     extract_tracks,
                      check_overlap,
                      get_bed_files)
 
@@ -72,60 +76,81 @@ class Feature(object):
         left = "%s\t%d\t%d" % (self.chrom, left_interval[0], left_interval[1])
         return right, left
         
-    def flanking_simulation(self, not_allowed_regions_bed, query_bed):
+    def flanking_simulation(self, not_allowed_regions_bed, query_beds,
+                            stats=("mean",), threshold=0.0):
         """
         Performs a simulation on features, selecting flanking intervals based on
-        input feature, extracts the region in query_bed containing scores and
-        calculates the mean score over the flanking region. It tries to get 
-        valid flanking regions (i.e, those that do not overlaps with regions in 
-        not_allowed_regions_dict and have scores annotated in query BEDs)
-        If the flanking region overlaps to not allowed regions or do not have
-        scores, the score will be 'NA'.
+        input feature, extracts the region in query_beds containing scores and
+        calculates the aggregations in stats over the flanking region. It tries
+        to get valid flanking regions (i.e, those that do not overlaps with
+        regions in not_allowed_regions_dict and have scores annotated in query
+        BEDs). If the flanking region overlaps to not allowed regions or do not
+        have scores, the score will be 'NA'.
 
         Arg1: not_allowed_regions_bed -> Must be a sorted bed file containing 
         regions to filter out.
-        Arg2: query_bed -> A filename of a BED file, containing all regions and
-        scores.
+        Arg2: query_beds -> A list of BED filenames, one per score track,
+        containing all regions and scores.
+        Arg3: stats -> A list of aggregation names (see calculate_scores()).
+        Arg4: threshold -> Score threshold used by 'frac_above'.
 
-        Returns -> A float score, which is the mean score of the flanking region.
-        If only right or left borders have scores, the score will be the one of
-        them. If both flanking regions have scores, it will be the mean of both,
-        and if no flanking regions have scores, it will be NA.
+        Returns -> A list of float scores (one per aggregation for each track)
+        of the flanking region. If only right or left borders have scores, the
+        score will be the one of them. If both flanking regions have scores,
+        they are combined by combine_flanking_scores(), and if no flanking
+        regions have scores, it will be NA.
 
         """
 
         # get right and left flanking regions
         right_flank, left_flank = self.flanking_regions()
         # check if the flanking region intersects with not allowed regions
-        intersect_r = run_bedextract(right_flank, not_allowed_regions_bed)
-        intersect_l = run_bedextract(left_flank, not_allowed_regions_bed)
+        intersect_r = cached_bedextract(right_flank, not_allowed_regions_bed)
+        intersect_l = cached_bedextract(left_flank, not_allowed_regions_bed)
         
         # testing right and left flanking regions and calculate scores
         # intersected regions not empty, means that overlap with not allowed 
         # regions so we do not want a score for that.
-        if (intersect_r != '') and (intersect_l != ''):
-            score = "NA"
-        elif (intersect_r != '') and (intersect_l == ''):
-            left_feature = run_bedextract(left_flank, query_bed)
-            score = calculate_mean_score(left_feature)
-        elif (intersect_r == '') and (intersect_l != ''):
-            right_feature = run_bedextract(right_flank, query_bed)
-            score = calculate_mean_score(right_feature)
-        elif (intersect_r == '') and (intersect_l == ''):
-            left_feature = run_bedextract(left_flank, query_bed)
-            right_feature = run_bedextract(right_flank, query_bed)
-            score_l = calculate_mean_score(left_feature)
-            score_r = calculate_mean_score(right_feature)
-            if score_l != "NA" and score_r != "NA":
-                score = mean([score_l, score_r])
-            elif score_l != "NA" and score_r == "NA":
-                score = score_l
-            elif score_l == "NA" and score_r != "NA":
-                score = score_r
-            elif score_l == "NA" and score_r == "NA":
-                score = "NA"
-        return score
+        scores = []
+        for query_bed in query_beds:
+            if intersect_r:
+                score_r = ["NA"] * len(stats)
+            else:
+                right_feature = cached_bedextract(right_flank, query_bed)
+                score_r = calculate_scores(right_feature, right_flank, stats,
+                                           threshold)
+            if intersect_l:
+                score_l = ["NA"] * len(stats)
+            else:
+                left_feature = cached_bedextract(left_flank, query_bed)
+                score_l = calculate_scores(left_feature, left_flank, stats,
+                                           threshold)
+            scores.extend(combine_flanking_scores(score_r, score_l, stats))
+        return scores
         
+    def observed_simulation(self, query_beds, stats=("mean",), threshold=0.0):
+        """
+        Extracts the feature region itself in query_beds containing scores and
+        calculates the aggregations in stats, giving the observed scores to be
+        compared with the simulations. If the feature has no scores, the score
+        will be 'NA'.
+
+        Arg1: query_beds -> A list of BED filenames, one per score track,
+        containing all regions and scores.
+        Arg2: stats -> A list of aggregation names (see calculate_scores()).
+        Arg3: threshold -> Score threshold used by 'frac_above'.
+
+        Returns -> A list of float scores (one per aggregation for each track)
+        of the feature region.
+
+        """
+
+        feature_string = "%s\t%s\t%s" % (self.chrom, self.start, self.end)
+        scores = []
+        for r in extract_tracks(feature_string, query_beds):
+            scores.extend(calculate_scores(r, feature_string, stats, threshold))
+        return scores
+
     def random_regions(self, allowed_regions):
         """
         By using feature start and end, select random intervals of the same
@@ -173,20 +198,26 @@ class Feature(object):
                 break    
         return random_region
 
-    def random_intragenic_simulation(self, allowed_regions_dict, query_bed):
+    def random_intragenic_simulation(self, allowed_regions_dict, query_beds,
+                                     stats=("mean",), threshold=0.0):
         """
         Performs a simulation on features, selecting random intervals based on
-        input feature, extracts the region in query_bed containing scores and
-        calculates the mean score over the selected region. It tries to get 
-        valid random regions (i.e, those annotated and having scores in query
-        BEDs) for 100 times. If the region is empty, the score will be 'NA'.
+        input feature, extracts the region in query_beds containing scores and
+        calculates the aggregations in stats over the selected region. It tries
+        to get valid random regions (i.e, those annotated and having scores in
+        at least one of the query BEDs) for 100 times. If the region is empty,
+        the score will be 'NA'. The same random region is scored in every
+        track.
 
         Arg1: allowed_regions_dict -> A dictionary containing allowed regions to
         generate random intervals.
-        Arg2: query_bed -> A filename of a BED file, containing all regions and
-        scores.
+        Arg2: query_beds -> A list of BED filenames, one per score track,
+        containing all regions and scores.
+        Arg3: stats -> A list of aggregation names (see calculate_scores()).
+        Arg4: threshold -> Score threshold used by 'frac_above'.
 
-        Returns -> A float score, which is the mean score of the random region.
+        Returns -> A list of float scores (one per aggregation for each track)
+        of the random region.
 
         """
         
@@ -194,30 +225,29 @@ class Feature(object):
         if "_" in self.name:
             names = self.name.split("_")
         else:
-            score = "NameError1"
-            return score
+            return ["NameError1"] * (len(query_beds) * len(stats))
         # get the combination of Gene, Transcript, Chromosome and Strand in
         # bed regions file dictionary (-b option)
         key = (names[1], names[2], self.chrom)
         if key in allowed_regions_dict:
             allowed_regions = allowed_regions_dict[key]
         else:
-            score = "NameError2"
-            return score
+            return ["NameError2"] * (len(query_beds) * len(stats))
 
         attempts = 0
         MAX_ATTEMPTS = 100
         while True:
             attempts += 1
             random_region = self.random_regions(allowed_regions)
-            random_features = run_bedextract(random_region, query_bed)
-            if random_features != '':
-                score = calculate_mean_score(random_features)
+            random_features = extract_tracks(random_region, query_beds)
+            if any(random_features):
                 break
             elif attempts == MAX_ATTEMPTS:
-                score = calculate_mean_score(random_features)
                 break
-        return score
+        scores = []
+        for r in random_features:
+            scores.extend(calculate_scores(r, random_region, stats, threshold))
+        return scores
 
 
     def random_flanking_regions(self, not_allowed_regions_bed,
@@ -257,22 +287,21 @@ class Feature(object):
                 attempts += 1
                 flanking = random.choice([right, left])
                 flank = "%s\t%d\t%d" % (self.chrom, flanking[0], flanking[1])
-                gene_overlap = run_bedextract(flank, not_allowed_regions_bed)
+                gene_overlap = cached_bedextract(flank, not_allowed_regions_bed)
                 # if flanking range overlaps to gene regions, get a shorter 
                 # interval.
-                if gene_overlap != '':
+                if gene_overlap:
                     # if the upstream border was chosen, get upstream 
                     # available region.
                     if flanking[1] < self.start:
-                        g_index = len(gene_overlap) - 1
-                        distance = self.start - int(gene_overlap[g_index].end)
+                        distance = self.start - gene_overlap[-1][1]
                         random_start = random.randrange(self.start - distance,
                                                         self.start)
                         random_end = random_start + self.size
                     # if the downstream border was chosen, get downstream 
                     # available region
                     elif flanking[1] > self.end:
-                        distance = int(gene_overlap[0].start) - self.end
+                        distance = gene_overlap[0][0] - self.end
                         random_start = random.randrange(self.end,
                                                         self.end + distance)
                         random_end = random_start + self.size
@@ -295,21 +324,29 @@ class Feature(object):
                     break
             return random_region
 
-    def random_flanking_simulation(self, not_allowed_regions_bed, query_bed,
-                                   window_r=10000, window_l=10000):
+    def random_flanking_simulation(self, not_allowed_regions_bed, query_beds,
+                                   window_r=10000, window_l=10000,
+                                   stats=("mean",), threshold=0.0):
         """
         Performs a simulation on features, selecting random intervals based on
-        input feature, extracts the region in query_bed containing scores and
-        calculates the mean score over the selected region. It tries to get 
-        valid random regions (i.e, those annotated and having scores in query
-        BEDs) for 100 times. If the region is empty, the score will be 'NA'.
-
-        Arg1: allowed_regions_dict -> A dictionary containing allowed regions to
-        generate random intervals.
-        Arg2: query_bed -> A filename of a BED file, containing all regions and
-        scores.
-
-        Returns -> A float score, which is the mean score of the random region.
+        input feature, extracts the region in query_beds containing scores and
+        calculates the aggregations in stats over the selected region. It tries
+        to get valid random regions (i.e, those annotated and having scores in
+        at least one of the query BEDs) for 100 times. If the region is empty,
+        the score will be 'NA'. The same random region is scored in every
+        track.
+
+        Arg1: not_allowed_regions_bed -> A sorted BED file containing regions
+        that cannot overlap with the generated random intervals.
+        Arg2: query_beds -> A list of BED filenames, one per score track,
+        containing all regions and scores.
+        Arg3/4: window_r/l -> Downstream and upstream windows in respect to
+        the feature coordinates.
+        Arg5: stats -> A list of aggregation names (see calculate_scores()).
+        Arg6: threshold -> Score threshold used by 'frac_above'.
+
+        Returns -> A list of float scores (one per aggregation for each track)
+        of the random region.
 
         """
 
@@ -321,14 +358,15 @@ class Feature(object):
                                                         not_allowed_regions_bed,
                                                         window_r, window_l)
 
-            random_features = run_bedextract(random_region, query_bed)
-            # Get score for non empty query features        
-            if random_features != '':
-                score = calculate_mean_score(random_features)
+            random_features = extract_tracks(random_region, query_beds)
+            # Get scores for non empty query features        
+            if any(random_features):
                 break
             elif attempts == MAX_ATTEMPTS:
-                score = calculate_mean_score(random_features)
                 break
-        return score
+        scores = []
+        for r in random_features:
+            scores.extend(calculate_scores(r, random_region, stats, threshold))
+        return scores
 
 
@@ -30,10 +30,14 @@ import random
 import glob
 import os
 import subprocess
-from numpy import mean
+from collections import OrderedDict
+from numpy import mean, median, array, clip
 from pybedtools import BedTool
 
 
+# aggregation functions accepted by calculate_scores() (--stat option)
+STATS = ["mean", "median", "max", "frac_above", "wmean"]
+
 
 def read_features(features_bed):
     """
@@ -98,6 +102,22 @@ def get_bed_files(dir_name):
     return dict_files
 
 
+def get_track_files(tracks, chrom):
+    """
+    Get the query BED file of a chromosome for each score track. Each track is
+    the dictionary returned by get_bed_files() for one directory of [-d].
+
+    Arg1: tracks -> A list of dictionaries associating chromosome names and
+    file names, one per score track.
+    Arg2: chrom -> The chromosome name. Ex: chrY.
+    Returns -> A list of file names, in the same order of tracks. Raises
+    KeyError if any track has no BED file for the chromosome.
+
+    """
+
+    return [ track[chrom] for track in tracks ]
+
+
 def check_overlap(feature_string, query_string):
     """
     Check overlap between two bed strings.
@@ -130,14 +150,195 @@ def run_bedextract(bed_region, bed_file):
     if bed_region == "NA\tNA\tNA":
         query_regions = ''
     else:
-        # echo bed_region
-        p1 = subprocess.Popen(['echo', '-e', bed_region], stdout=subprocess.PIPE)
-        # pipe echo to bedextract
-        p2 = subprocess.Popen(['bedextract', bed_file, '-'], stdin=p1.stdout,
-                              stdout=subprocess.PIPE).stdout.read()
-        p1.stdout.close()
+        p2 = bedextract_output(bed_region, bed_file)
         query_regions = BedTool(p2, from_string=True)
     return query_regions
+
+
+def bedextract_output(bed_region, bed_file):
+    """
+    Run 'bedextract' from BEDOPS package for a given region of a big query BED
+    file and get its raw output.
+
+    Arg1: bed_region -> bed region in string format. Ex: "chrX\tstart\tend"
+    Arg2: bed_file -> A SORTED bed file containing query regions.
+    Returns -> A string of all lines in query BED overlapping with bed_region.
+
+    """
+
+    # echo bed_region
+    p1 = subprocess.Popen(['echo', '-e', bed_region], stdout=subprocess.PIPE)
+    # pipe echo to bedextract
+    p2 = subprocess.Popen(['bedextract', bed_file, '-'], stdin=p1.stdout,
+                          stdout=subprocess.PIPE).stdout.read()
+    p1.stdout.close()
+    return p2
+
+
+def parse_bed_records(bed_string):
+    """
+    Parse BED lines into (start, end, score) tuples, the same records yielded
+    by sweep.sweep_bed().
+
+    Arg1: bed_string -> A string of BED lines. Ex: the output of bedextract.
+    Returns -> A list of tuples (start, end, score), where score is the 5th
+    BED field as a string (or None if the line has no score field).
+
+    """
+
+    records = []
+    for line in bed_string.splitlines():
+        fields = line.split("\t")
+        if len(fields) < 3:
+            continue
+        score = fields[4] if len(fields) > 4 else None
+        records.append((int(fields[1]), int(fields[2]), score))
+    return records
+
+
+class RegionCache(object):
+    """
+    A bounded LRU (least recently used) cache for the results of region
+    lookups in BED files, keyed by (chrom, start, end, source), where source
+    is the BED file name. It keeps hit and miss counts to report its
+    hit rate.
+
+    """
+
+    def __init__(self, maxsize=10000):
+        """
+        Initialize an empty cache holding at most maxsize results. A maxsize
+        of 0 disables the cache.
+
+        """
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """
+        Get a cached result, marking it as the most recently used.
+
+        Arg1: key -> A tuple (chrom, start, end, source).
+        Returns -> The cached result, or None if key is not cached.
+
+        """
+
+        if key in self._data:
+            self.hits += 1
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Cache a result, removing the least recently used one if the cache is
+        full.
+
+        Arg1: key -> A tuple (chrom, start, end, source).
+        Arg2: value -> The result to be cached.
+        Returns -> None.
+
+        """
+
+        if self.maxsize <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def resize(self, maxsize):
+        """
+        Change the maximum number of cached results, removing the least
+        recently used ones if needed.
+
+        """
+
+        self.maxsize = maxsize
+        while self._data and len(self._data) > max(maxsize, 0):
+            self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all cached results. Hit and miss counts are kept.
+
+        """
+
+        self._data.clear()
+
+    def hit_rate(self):
+        """
+        Returns -> The fraction of lookups found in the cache, or 0.0 if
+        there were no lookups.
+
+        """
+
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def __len__(self):
+        return len(self._data)
+
+    def __str__(self):
+        return "cache: %d hits, %d misses, hit rate %.3f, %d/%d entries" % (
+            self.hits, self.misses, self.hit_rate(), len(self), self.maxsize)
+
+
+# shared by all Feature simulation methods (see cached_bedextract())
+EXTRACT_CACHE = RegionCache()
+
+
+def cached_bedextract(bed_region, bed_file, cache=EXTRACT_CACHE):
+    """
+    Extract a region from a big query BED file with bedextract, like
+    run_bedextract(), keeping the parsed records in a RegionCache, so repeated
+    lookups of the same region in the same BED file (e.g. flanking windows
+    tested in every attempt of a simulation, or flanks shared by neighbouring
+    features) do not call bedextract again. Records are plain tuples, not
+    BedTool objects, so they do not depend on pybedtools temporary files and
+    stay valid after pybedtools.cleanup().
+
+    Arg1: bed_region -> bed region in string format. Ex: "chrX\tstart\tend"
+    Arg2: bed_file -> A SORTED bed file containing query regions.
+    Arg3: cache -> A RegionCache object. Default is the shared EXTRACT_CACHE.
+    Returns -> A list of tuples (start, end, score) of all regions in query
+    BED overlapping with bed_region (see parse_bed_records()). It is empty if
+    there are none or if bed_region is "NA\tNA\tNA".
+
+    """
+
+    if bed_region == "NA\tNA\tNA":
+        return []
+    chrom, start, end = bed_region.split("\t")[0:3]
+    key = (chrom, int(start), int(end), bed_file)
+    records = cache.get(key)
+    if records is None:
+        records = parse_bed_records(bedextract_output(bed_region, bed_file))
+        cache.put(key, records)
+    return records
+
+
+def extract_tracks(bed_region, bed_files):
+    """
+    Extract the same region from several query BED files (score tracks) by
+    calling cached_bedextract() for each of them, so all tracks are scored
+    over identical intervals.
+
+    Arg1: bed_region -> bed region in string format. Ex: "chrX\tstart\tend"
+    Arg2: bed_files -> A list of SORTED bed files, one per score track.
+    Returns -> A list of the values returned by cached_bedextract(), in the
+    same order of bed_files.
+
+    """
+
+    return [ cached_bedextract(bed_region, bed_file) for bed_file in bed_files ]
     
 
 def calculate_mean_score(query_regions):
@@ -163,3 +364,118 @@ def calculate_mean_score(query_regions):
     return mean_score
 
 
+def calculate_scores(query_regions, bed_region, stats=("mean",),
+                     threshold=0.0):
+    """
+    Calculates several aggregations of the phylop (or other) scores of a range
+    of features at once, reading the extracted features a single time (see
+    summarize_scores()).
+
+    Arg1: query_regions -> It is usually the returned value of
+    cached_bedextract(), which is a list of tuples (start, end, score) of a
+    range of features.
+    Arg2: bed_region -> bed region in string format used to extract
+    query_regions. Ex: "chrX\tstart\tend". It is needed by 'frac_above' and
+    'wmean'.
+    Arg3: stats -> A list of aggregation names, in the output order.
+    Arg4: threshold -> Score threshold used by 'frac_above'.
+    Returns -> A list of float values, one per aggregation in stats. All of
+    them are 'NA' if the interval was not found in query bed file.
+
+    """
+
+    # in case of not finding the interval in query bed file.
+    if not query_regions:
+        return ["NA"] * len(stats)
+
+    records = [ (r[0], r[1], float(r[2])) for r in query_regions ]
+    region_start, region_end = [ int(i) for i in bed_region.split("\t")[1:3] ]
+    return summarize_scores(records, region_start, region_end, stats,
+                            threshold)
+
+
+def summarize_scores(records, region_start, region_end, stats=("mean",),
+                     threshold=0.0):
+    """
+    Calculates several aggregations of the scores of the features overlapping
+    a region. Available aggregations (see STATS) are:
+        mean -> mean score, the same value of calculate_mean_score().
+        median -> median score.
+        max -> maximum score.
+        frac_above -> fraction of the bases covered by the region with score
+        above threshold.
+        wmean -> mean score weighted by the number of bases of each feature
+        covered by the region.
+
+    Arg1: records -> A list of tuples (start, end, score) of the features.
+    Arg2/3: region_start/end -> Coordinates of the region. Used by
+    'frac_above' and 'wmean'.
+    Arg4: stats -> A list of aggregation names, in the output order.
+    Arg5: threshold -> Score threshold used by 'frac_above'.
+    Returns -> A list of float values, one per aggregation in stats. All of
+    them are 'NA' if records is empty.
+
+    """
+
+    if not records:
+        return ["NA"] * len(stats)
+
+    starts = array([ r[0] for r in records ])
+    ends = array([ r[1] for r in records ])
+    scores = array([ r[2] for r in records ])
+    # number of bases of each record inside the region
+    covered = (clip(ends, region_start, region_end) -
+               clip(starts, region_start, region_end))
+
+    values = []
+    for stat in stats:
+        if stat == "mean":
+            values.append(mean(scores))
+        elif stat == "median":
+            values.append(median(scores))
+        elif stat == "max":
+            values.append(scores.max())
+        elif stat == "frac_above":
+            if covered.sum() > 0:
+                values.append(float(covered[scores > threshold].sum()) /
+                              covered.sum())
+            else:
+                values.append("NA")
+        elif stat == "wmean":
+            if covered.sum() > 0:
+                values.append(float((scores * covered).sum()) / covered.sum())
+            else:
+                values.append("NA")
+        else:
+            raise ValueError("Unknown aggregation '%s'." % stat)
+    return values
+
+
+def combine_flanking_scores(scores_r, scores_l, stats=("mean",)):
+    """
+    Combine the aggregations of right and left flanking regions into a single
+    value per aggregation. 'max' keeps the largest of both flanks and the
+    others are averaged. If only one flank has a value, it is used, and if
+    none of them has, the value will be 'NA'.
+
+    Arg1/2: scores_r/l -> Lists returned by calculate_scores() for right and
+    left flanking regions.
+    Arg3: stats -> A list of aggregation names, as given to calculate_scores().
+    Returns -> A list of combined values, one per aggregation in stats.
+
+    """
+
+    values = []
+    for stat, score_r, score_l in zip(stats, scores_r, scores_l):
+        if score_l != "NA" and score_r != "NA":
+            if stat == "max":
+                values.append(max(score_l, score_r))
+            else:
+                values.append(mean([score_l, score_r]))
+        elif score_l != "NA" and score_r == "NA":
+            values.append(score_l)
+        elif score_l == "NA" and score_r != "NA":
+            values.append(score_r)
+        else:
+            values.append("NA")
+    return values
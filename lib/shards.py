@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Author: agent
+Program name: shards.py
+Date: 2026-10-18
+Last date modified: 2026-10-18
+License: GPL
+
+1. What it does:
+   Functions to split a simulation run into independent work units (shards),
+   so it can be executed as an array job with no shared memory, and to merge
+   the shard outputs back into the final result. The feature set x replicate
+   range is partitioned into N shard manifests (JSON files), each one carrying
+   the simulation options, its random seed, the input file hashes and the
+   feature offsets (segments) it is responsible for.
+
+2. Input:
+   None
+
+3. Output:
+   None
+
+4. Usage:
+   import shards
+
+"""
+
+
+import os
+import glob
+import json
+import random
+import hashlib
+
+
+MANIFEST_VERSION = 1
+HEADER = "#shard"
+FOOTER = "#done"
+
+
+def hash_file(filename, block_size=1 << 20):
+    """
+    Calculates the md5 hash of a file, reading it in blocks.
+
+    Arg1: filename -> The name of the file.
+    Arg2: block_size -> Number of bytes read at a time.
+    Returns -> A string of the hexadecimal md5 digest.
+
+    """
+
+    md5 = hashlib.md5()
+    with open(filename, "rb") as handle:
+        block = handle.read(block_size)
+        while block:
+            md5.update(block)
+            block = handle.read(block_size)
+    return md5.hexdigest()
+
+
+def hash_directory(dir_name):
+    """
+    Calculates a fingerprint of a directory of score BED files (-d option),
+    using the names and sizes of its BED files. Score files are usually huge
+    (several GB per track), so their content is not hashed.
+
+    Arg1: dir_name -> The name of the directory.
+    Returns -> A string of the hexadecimal md5 digest.
+
+    """
+
+    md5 = hashlib.md5()
+    for f in sorted(glob.glob(dir_name + "/*.bed")):
+        md5.update("%s\t%d\n" % (os.path.basename(f), os.path.getsize(f)))
+    return md5.hexdigest()
+
+
+def hash_inputs(options):
+    """
+    Get the hashes of all input files of a simulation.
+
+    Arg1: options -> A dictionary of simulation options (see plan_shards()).
+    Returns -> A dictionary associating each input file (or score directory)
+    to its hash.
+
+    """
+
+    hashes = {}
+    hashes[options["features_bed"]] = hash_file(options["features_bed"])
+    # regions are not used by observed scores
+    if options["regions_bed"] is not None:
+        hashes[options["regions_bed"]] = hash_file(options["regions_bed"])
+    for dir_name in options["dirname_bed"]:
+        hashes[dir_name] = hash_directory(dir_name)
+    return hashes
+
+
+def check_inputs(manifest):
+    """
+    Check if the input files of a shard are the same used to plan it.
+
+    Arg1: manifest -> A shard manifest dictionary.
+    Returns -> None. Raises IOError if any input file has changed.
+
+    """
+
+    hashes = hash_inputs(manifest["options"])
+    for name, value in manifest["hashes"].items():
+        if hashes.get(name) != value:
+            raise IOError("Input '%s' has changed since shard was planned."
+                          % name)
+
+
+def split_units(n_features, number, n_shards):
+    """
+    Partition the feature set x replicate range into contiguous shards of
+    (almost) the same size. Work units are ordered by feature and then by
+    replicate, so each shard covers a range of features and each feature has
+    at most a few replicate ranges split across shards.
+
+    Arg1: n_features -> Number of input features.
+    Arg2: number -> Number of simulations (replicates) per feature.
+    Arg3: n_shards -> Number of shards.
+    Returns -> A list of n_shards lists of segments. A segment is a list
+    [feature_index, rep_start, rep_end], with rep_end not included. Shards may
+    be empty if there are fewer work units than shards.
+
+    """
+
+    total = n_features * number
+    shards = []
+    for i in range(0, n_shards):
+        first = total * i // n_shards
+        last = total * (i + 1) // n_shards
+        segments = []
+        unit = first
+        while unit < last:
+            feature_index = unit // number
+            rep_start = unit % number
+            rep_end = min(number, rep_start + (last - unit))
+            segments.append([feature_index, rep_start, rep_end])
+            unit += rep_end - rep_start
+        shards.append(segments)
+    return shards
+
+
+def plan_shards(options, n_features, n_shards, seed=None):
+    """
+    Create the manifests of all shards of a simulation run.
+
+    Arg1: options -> A dictionary of simulation options, with the keys
+    features_bed, dirname_bed, regions_bed (None for observed scores), mode
+    ('flanking', 'random', 'random_flank' or 'observed'), sweep, cache_size,
+    number, window_down, window_up, stats and threshold.
+    Arg2: n_features -> Number of features in features_bed.
+    Arg3: n_shards -> Number of shards.
+    Arg4: seed -> Master random seed. Each shard gets its own seed derived
+    from it. If None, a random one is chosen.
+    Returns -> A list of shard manifest dictionaries.
+
+    """
+
+    if seed is None:
+        seed = random.randrange(0, 2 ** 31)
+    hashes = hash_inputs(options)
+    md5 = hashlib.md5(json.dumps([options, hashes, seed, n_shards],
+                                 sort_keys=True))
+    plan_id = md5.hexdigest()
+    rng = random.Random(seed)
+
+    manifests = []
+    for shard, segments in enumerate(split_units(n_features,
+                                                 options["number"],
+                                                 n_shards)):
+        manifest = {"version": MANIFEST_VERSION,
+                    "plan_id": plan_id,
+                    "shard": shard,
+                    "n_shards": n_shards,
+                    "n_features": n_features,
+                    "seed": rng.randrange(0, 2 ** 31),
+                    "options": options,
+                    "hashes": hashes,
+                    "segments": segments}
+        manifests.append(manifest)
+    return manifests
+
+
+def write_manifests(manifests, out_dir):
+    """
+    Write shard manifests as JSON files in a directory.
+
+    Arg1: manifests -> A list returned by plan_shards().
+    Arg2: out_dir -> The output directory. It is created if needed.
+    Returns -> A list of manifest file names, in shard order.
+
+    """
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    filenames = []
+    for manifest in manifests:
+        filename = os.path.join(out_dir, "shard_%05d.json" % manifest["shard"])
+        with open(filename, "w") as handle:
+            json.dump(manifest, handle, indent=1, sort_keys=True)
+        filenames.append(filename)
+    return filenames
+
+
+def read_manifest(filename):
+    """
+    Read a shard manifest JSON file.
+
+    Arg1: filename -> The name of the manifest file.
+    Returns -> A shard manifest dictionary. Raises ValueError if the manifest
+    version is not supported.
+
+    """
+
+    with open(filename) as handle:
+        manifest = json.load(handle)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError("Unsupported manifest version in '%s'." % filename)
+    return manifest
+
+
+def shard_header(manifest):
+    """
+    Get the header line of a shard output, identifying its plan and shard.
+
+    Arg1: manifest -> A shard manifest dictionary.
+    Returns -> A string of the header line.
+
+    """
+
+    return "%s\t%s\t%d\t%d\t%d\t%d" % (HEADER, manifest["plan_id"],
+                                       manifest["shard"], manifest["n_shards"],
+                                       manifest["n_features"],
+                                       manifest["options"]["number"])
+
+
+def shard_footer(lines):
+    """
+    Get the footer line of a shard output, containing the number and the md5
+    hash of all output lines, so truncated or edited outputs can be detected.
+
+    Arg1: lines -> A list of the segment lines of the shard output.
+    Returns -> A string of the footer line.
+
+    """
+
+    md5 = hashlib.md5("\n".join(lines))
+    return "%s\t%d\t%s" % (FOOTER, len(lines), md5.hexdigest())
+
+
+def segment_line(segment, output):
+    """
+    Get the output line of a segment, which is the output of the simulation
+    for a single feature, prefixed by the segment coordinates.
+
+    Arg1: segment -> A list [feature_index, rep_start, rep_end].
+    Arg2: output -> The output line printed by the simulation.
+    Returns -> A string of the segment line.
+
+    """
+
+    return "%d\t%d\t%d\t%s" % (segment[0], segment[1], segment[2], output)
+
+
+def read_shard_output(filename):
+    """
+    Read a shard output file and check its integrity.
+
+    Arg1: filename -> The name of the shard output file.
+    Returns -> A tuple (plan_id, shard, n_shards, n_features, number,
+    segments), where segments is a list of tuples (feature_index, rep_start,
+    rep_end, output). Raises
+    ValueError if the file has no header or its footer does not match.
+
+    """
+
+    with open(filename) as handle:
+        lines = [ line.rstrip("\n") for line in handle ]
+    if not lines or not lines[0].startswith(HEADER + "\t"):
+        raise ValueError("Missing shard header in '%s'." % filename)
+    if len(lines) < 2 or lines[-1] != shard_footer(lines[1:-1]):
+        raise ValueError("Shard output '%s' is incomplete or corrupted."
+                         % filename)
+    header = lines[0].split("\t")
+    segments = []
+    for line in lines[1:-1]:
+        fields = line.split("\t", 3)
+        segments.append((int(fields[0]), int(fields[1]), int(fields[2]),
+                         fields[3]))
+    return (header[1], int(header[2]), int(header[3]), int(header[4]),
+            int(header[5]), segments)
+
+
+def merge_shard_outputs(filenames):
+    """
+    Merge shard outputs into the final simulation output, in the order of
+    input features, checking that all shards of the same plan are present and
+    that every replicate of every feature was simulated exactly once.
+
+    Arg1: filenames -> A list of shard output file names, in any order.
+    Returns -> A list of output lines, one per feature, as printed by a
+    non-sharded run. Raises ValueError if an integrity check fails.
+
+    """
+
+    plan_ids = set()
+    shards = {}
+    n_shards = n_features = number = None
+    for filename in filenames:
+        (plan_id, shard, n_shards, n_features, number,
+         segments) = read_shard_output(filename)
+        plan_ids.add(plan_id)
+        if shard in shards:
+            raise ValueError("Shard %d was given more than once." % shard)
+        shards[shard] = segments
+    if len(plan_ids) != 1:
+        raise ValueError("Shard outputs come from different plans.")
+    missing = sorted(set(range(0, n_shards)) - set(shards))
+    if missing:
+        raise ValueError("Missing shard outputs: %s."
+                         % ", ".join([ str(i) for i in missing ]))
+
+    # collect segments of each feature, in replicate order
+    features = {}
+    for shard in sorted(shards):
+        for feature_index, rep_start, rep_end, output in shards[shard]:
+            features.setdefault(feature_index, []).append((rep_start, rep_end,
+                                                           output))
+    if sorted(features) != range(0, n_features):
+        raise ValueError("Some features were not simulated.")
+    lines = []
+    for feature_index in sorted(features):
+        segments = sorted(features[feature_index])
+        expected = 0
+        for rep_start, rep_end, output in segments:
+            if rep_start != expected:
+                raise ValueError("Replicates of feature %d are missing or "
+                                 "overlapping." % feature_index)
+            expected = rep_end
+        if expected != number:
+            raise ValueError("Replicates of feature %d are missing."
+                             % feature_index)
+        # features without a score BED file have a single message line
+        if "\t" not in segments[0][2]:
+            lines.append(segments[0][2])
+            continue
+        columns = [segments[0][2]]
+        for rep_start, rep_end, output in segments[1:]:
+            columns.append(output.split("\t", 1)[1])
+        lines.append("\t".join(columns))
+    return lines
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Author: agent
+Program name: sweep.py
+Date: 2026-10-18
+Last date modified: 2026-10-18
+License: GPL
+
+1. What it does:
+   A merge-join sweep engine over SORTED BED files. Instead of calling
+   bedextract once per interval, each BED file is streamed a single time
+   alongside a sorted queue of all requested intervals, and the records
+   overlapping each interval are emitted as soon as the interval is closed.
+   This gives O(records + intervals) I/O, keeping in memory only the records
+   of the intervals currently open.
+
+2. Input:
+   None
+
+3. Output:
+   None
+
+4. Usage:
+   import sweep
+
+"""
+
+
+from libtools import summarize_scores
+
+
+def sweep_bed(bed_file, intervals, buffer_size=1 << 20):
+    """
+    Stream a sorted BED file once and find the records overlapping each of
+    the requested intervals, with the same overlap rule of bedextract (a
+    record overlaps if record.start < interval.end and record.end >
+    interval.start). Records of each chromosome must be contiguous and sorted
+    by start, as done by 'sort-bed'. Intervals may be given in any order.
+
+    Arg1: bed_file -> A SORTED bed file. Ex: a score BED of a chromosome or a
+    BED of not allowed regions.
+    Arg2: intervals -> A list of tuples (chrom, start, end, key), where key is
+    any hashable value identifying the interval.
+    Arg3: buffer_size -> Number of bytes of the file read at a time.
+    Yields -> Tuples (key, records) for every interval, as the intervals are
+    closed. records is a list of tuples (start, end, score) of the
+    overlapping records, where score is the 5th BED field as a string (or
+    None if the file has no score field).
+
+    """
+
+    by_chrom = {}
+    for chrom, start, end, key in intervals:
+        by_chrom.setdefault(chrom, []).append((start, end, key))
+    for chrom in by_chrom:
+        by_chrom[chrom].sort()
+    remaining = set(by_chrom)
+
+    chrom = None
+    pending = []
+    i = 0
+    active = []
+    with open(bed_file, "r", buffer_size) as handle:
+        for line in handle:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            # new chromosome: close all intervals of the previous one
+            if fields[0] != chrom:
+                for interval in active:
+                    yield interval[2], interval[3]
+                for start, end, key in pending[i:]:
+                    yield key, []
+                chrom = fields[0]
+                pending = by_chrom.get(chrom, [])
+                i = 0
+                active = []
+                remaining.discard(chrom)
+            if i == len(pending) and not active:
+                # nothing else to find in the file
+                if not remaining:
+                    break
+                continue
+
+            start, end = int(fields[1]), int(fields[2])
+            # close intervals ending before this record. Next records start
+            # after it, so they cannot overlap these intervals.
+            still_active = []
+            for interval in active:
+                if interval[1] <= start:
+                    yield interval[2], interval[3]
+                else:
+                    still_active.append(interval)
+            active = still_active
+            # open intervals starting before the end of this record
+            while i < len(pending) and pending[i][0] < end:
+                interval_start, interval_end, key = pending[i]
+                i += 1
+                if interval_end <= start:
+                    yield key, []
+                else:
+                    active.append([interval_start, interval_end, key, []])
+            if active:
+                score = fields[4] if len(fields) > 4 else None
+                # a long record may have opened intervals after this one
+                for interval in active:
+                    if interval[0] < end:
+                        interval[3].append((start, end, score))
+
+    for interval in active:
+        yield interval[2], interval[3]
+    for start, end, key in pending[i:]:
+        yield key, []
+    for chrom in remaining:
+        for start, end, key in by_chrom[chrom]:
+            yield key, []
+
+
+def sweep_overlaps(bed_file, intervals):
+    """
+    Find which intervals overlap any region of a sorted BED file (usually the
+    not allowed regions), streaming the file a single time.
+
+    Arg1: bed_file -> A SORTED bed file containing regions.
+    Arg2: intervals -> A list of tuples (chrom, start, end, key).
+    Returns -> A set of the keys of the overlapping intervals.
+
+    """
+
+    return set([ key for key, records in sweep_bed(bed_file, intervals)
+                 if records ])
+
+
+def sweep_scores(tracks, intervals, stats=("mean",), threshold=0.0):
+    """
+    Calculates the aggregations of the scores of each interval for all score
+    tracks, streaming each chromosome score file of each track a single time.
+
+    Arg1: tracks -> A list of dictionaries associating chromosome names and
+    file names, one per score track (see libtools.get_bed_files()). Every
+    track must have a file for the chromosomes of intervals.
+    Arg2: intervals -> A list of tuples (chrom, start, end, key).
+    Arg3: stats -> A list of aggregation names (see libtools.STATS).
+    Arg4: threshold -> Score threshold used by 'frac_above'.
+    Returns -> A dictionary associating each key to a list (one per track) of
+    lists of aggregation values, as returned by libtools.summarize_scores().
+
+    """
+
+    by_chrom = {}
+    coordinates = {}
+    for interval in intervals:
+        by_chrom.setdefault(interval[0], []).append(interval)
+        coordinates[interval[3]] = (interval[1], interval[2])
+
+    scores = dict([ (interval[3], []) for interval in intervals ])
+    for track in tracks:
+        for chrom in sorted(by_chrom):
+            for key, records in sweep_bed(track[chrom], by_chrom[chrom]):
+                start, end = coordinates[key]
+                records = [ (r[0], r[1], float(r[2])) for r in records ]
+                scores[key].append(summarize_scores(records, start, end,
+                                                    stats, threshold))
+    return scores
@@ -11,7 +11,10 @@ License: GPL
 1. What it does:
    Performs phyloP (or other scoring system) on random or flanking regions of
    input features. A feature object is created and the simulation methods are
-   called, depending of with type of simulation we want to perform.
+   called, depending of with type of simulation we want to perform. Observed
+   scores of the features themselves can also be calculated. Flanking and
+   observed scores can be calculated by streaming the sorted Bed files once
+   (sweep), instead of querying them for every interval.
 
 2. Input:
    A Bed file containing features to be simulated. Sorted Bed files of each
@@ -22,29 +25,47 @@ License: GPL
    flanking_simulation() method).
 
 3. Output:
-   Feature name and mean scores for flanking or random simulations.
+   Feature name and mean scores for flanking or random simulations, with one
+   column per score track for each simulation.
 
 4. Usage:
    python simulation_features.py --help
+   python simulation_features.py plan|run-shard|merge --help
 
 """
 
 
+import os
 import sys
+import random
 import argparse
+from StringIO import StringIO
+from pybedtools import cleanup
 import lib
 from lib.features import Feature
-from lib.libtools import read_features, get_bed_files, get_regions
-
-
-def call_flanking_simulation(features, bed_files, not_allowed_regions_bed):
+from lib.libtools import (read_features, get_bed_files, get_regions,
+                          get_track_files, combine_flanking_scores, STATS,
+                          EXTRACT_CACHE)
+from lib.sweep import sweep_overlaps, sweep_scores
+from lib.shards import (plan_shards, write_manifests, read_manifest,
+                        check_inputs, shard_header, shard_footer,
+                        segment_line, merge_shard_outputs)
+
+
+def call_flanking_simulation(features, tracks, not_allowed_regions_bed,
+                             stats=("mean",), threshold=0.0,
+                             output=sys.stdout):
     """
     Perform simulations for all features, calling flanking_simulation().
     
     Arg1: features -> BedTool object for all features.
-    Arg2: bed_files -> dictionary of chromosome and query BED file names.
+    Arg2: tracks -> list of dictionaries of chromosome and query BED file
+    names, one per score track.
     Arg3: not_allowed_regions_dict -> dictionary of not allowed regions, which 
     is the search space to avoid flanking regions.
+    Arg4: stats -> list of aggregations to be calculated for each track.
+    Arg5: threshold -> score threshold used by 'frac_above' aggregation.
+    Arg6: output -> file object where the output is printed.
 
     Returns -> None. Just prints out the output.
 
@@ -52,28 +73,37 @@ def call_flanking_simulation(features, bed_files, not_allowed_regions_bed):
  
     for f in features:
         feature = Feature(f) # create feature object
-        # get the correct bed file for specific chromosome
+        # get the correct bed file of each track for specific chromosome
         try:
-            query_bed = bed_files[feature.chrom]
+            query_beds = get_track_files(tracks, feature.chrom)
         except KeyError:
-            print "Could not find a BED file for %s." % (feature.chrom)
+            print >> output, "Could not find a BED file for %s." % (
+                feature.chrom)
             continue
         
-        score = feature.flanking_simulation(not_allowed_regions_bed, query_bed)
-        out = "%s\t%s" % (feature.name, str(score))
-        print out
+        scores = feature.flanking_simulation(not_allowed_regions_bed,
+                                             query_beds, stats, threshold)
+        s = "\t".join([ str(i) for i in scores ])
+        out = "%s\t%s" % (feature.name, s)
+        print >> output, out
 
 
-def call_random_intragenic_simulation(features, bed_files,
-                                      allowed_regions_dict, number=1):
+def call_random_intragenic_simulation(features, tracks,
+                                      allowed_regions_dict, number=1,
+                                      stats=("mean",), threshold=0.0,
+                                      output=sys.stdout):
     """
     Perform simulations for all features, calling random_simulation_intragenic()
     
     Arg1: features -> BedTool object for all features.
-    Arg2: bed_files -> dictionary of chromosome and query BED file names.
+    Arg2: tracks -> list of dictionaries of chromosome and query BED file
+    names, one per score track.
     Arg3: allowed_regions_dict -> dictionary of allowed regions, which is the
     search space to generate random intervals and get scores.
     Arg4: number -> Number of simulations to be performed.
+    Arg5: stats -> list of aggregations to be calculated for each track.
+    Arg6: threshold -> score threshold used by 'frac_above' aggregation.
+    Arg7: output -> file object where the output is printed.
 
     Returns -> None. Just prints out the output.
 
@@ -81,70 +111,208 @@ def call_random_intragenic_simulation(features, bed_files,
     
     for f in features:
         feature = Feature(f) # create feature object
-        # get the correct bed file for specific chromosome
+        # get the correct bed file of each track for specific chromosome
         try:
-            query_bed = bed_files[feature.chrom]
+            query_beds = get_track_files(tracks, feature.chrom)
         except KeyError:
-            print "Could not find a BED file for %s." % (feature.chrom)
+            print >> output, "Could not find a BED file for %s." % (
+                feature.chrom)
             continue
 
         scores = []
         for n in range(0, number):
             score = feature.random_intragenic_simulation(allowed_regions_dict,
-                                                         query_bed)
-            scores.append(score)
+                                                         query_beds, stats,
+                                                         threshold)
+            scores.extend(score)
         # prepare output
         s = "\t".join([ str(i) for i in scores ])
         out = "%s\t%s" % (feature.name, s)
-        print out
+        print >> output, out
 
 
-def call_random_flanking_simulation(features, bed_files, 
+def call_random_flanking_simulation(features, tracks, 
                                     not_allowed_regions_bed, number=1,
-                                    window_r=10000, window_l=10000):
+                                    window_r=10000, window_l=10000,
+                                    stats=("mean",), threshold=0.0,
+                                    output=sys.stdout):
     """
     Perform simulations for all features, calling random_flanking_simulation()
     
     Arg1: features -> BedTool object for all features.
-    Arg2: bed_files -> dictionary of chromosome and query BED file names.
+    Arg2: tracks -> list of dictionaries of chromosome and query BED file
+    names, one per score track.
     Arg3: not_allowed_regions_dict -> dictionary of not allowed regions, which 
     is the search space to avoid flanking regions.
     Arg4: number -> Number of simulations to be performed.
     Arg5/6: window_r/l -> Downstream and upstream windows in respect to the
     feature coordinates.
+    Arg7: stats -> list of aggregations to be calculated for each track.
+    Arg8: threshold -> score threshold used by 'frac_above' aggregation.
+    Arg9: output -> file object where the output is printed.
     Returns -> None. Just prints out the output.
 
     """
 
     for f in features:
         feature = Feature(f) # create feature object
-        # get the correct bed file for specific chromosome
+        # get the correct bed file of each track for specific chromosome
         try:
-            query_bed = bed_files[feature.chrom]
+            query_beds = get_track_files(tracks, feature.chrom)
         except KeyError:
-            print "Could not find a BED file for %s." % (feature.chrom)
+            print >> output, "Could not find a BED file for %s." % (
+                feature.chrom)
             continue
         
         scores = []
         for n in range(0, number):
             score = feature.random_flanking_simulation(not_allowed_regions_bed,
-                                                       query_bed,
+                                                       query_beds,
                                                        window_r,
-                                                       window_l)
-            scores.append(score)
+                                                       window_l,
+                                                       stats,
+                                                       threshold)
+            scores.extend(score)
         # prepare output
         s = "\t".join([ str(i) for i in scores ])
         out = "%s\t%s" % (feature.name, s)
-        print out
+        print >> output, out
 
 
-def main():
+def call_observed_simulation(features, tracks, stats=("mean",),
+                             threshold=0.0, output=sys.stdout):
     """
-    Get arguments and call functions to perform score simulations on features.
+    Get the observed scores of all features, calling observed_simulation().
+
+    Arg1: features -> BedTool object for all features.
+    Arg2: tracks -> list of dictionaries of chromosome and query BED file
+    names, one per score track.
+    Arg3: stats -> list of aggregations to be calculated for each track.
+    Arg4: threshold -> score threshold used by 'frac_above' aggregation.
+    Arg5: output -> file object where the output is printed.
+
+    Returns -> None. Just prints out the output.
+
+    """
+
+    for f in features:
+        feature = Feature(f) # create feature object
+        # get the correct bed file of each track for specific chromosome
+        try:
+            query_beds = get_track_files(tracks, feature.chrom)
+        except KeyError:
+            print >> output, "Could not find a BED file for %s." % (
+                feature.chrom)
+            continue
+
+        scores = feature.observed_simulation(query_beds, stats, threshold)
+        s = "\t".join([ str(i) for i in scores ])
+        out = "%s\t%s" % (feature.name, s)
+        print >> output, out
+
+
+def call_sweep_flanking_simulation(features, tracks, not_allowed_regions_bed,
+                                   stats=("mean",), threshold=0.0,
+                                   output=sys.stdout):
+    """
+    Perform flanking simulations for all features at once, with the same
+    result of call_flanking_simulation(). Instead of calling bedextract for
+    every flanking region, the not allowed regions BED and each score BED are
+    streamed a single time (see lib.sweep).
+
+    Arg1: features -> BedTool object for all features.
+    Arg2: tracks -> list of dictionaries of chromosome and query BED file
+    names, one per score track.
+    Arg3: not_allowed_regions_bed -> sorted BED file of not allowed regions,
+    which is the search space to avoid flanking regions.
+    Arg4: stats -> list of aggregations to be calculated for each track.
+    Arg5: threshold -> score threshold used by 'frac_above' aggregation.
+    Arg6: output -> file object where the output is printed.
+
+    Returns -> None. Just prints out the output.
 
     """
 
-    parser = argparse.ArgumentParser(description="""Performs simulations on 
+    features = [ Feature(f) for f in features ]
+    intervals = []
+    for index, feature in enumerate(features):
+        # features without a bed file are reported when printing the output
+        try:
+            get_track_files(tracks, feature.chrom)
+        except KeyError:
+            continue
+        right_flank, left_flank = feature.flanking_regions()
+        for side, flank in (("r", right_flank), ("l", left_flank)):
+            chrom, start, end = flank.split("\t")
+            intervals.append((chrom, int(start), int(end), (index, side)))
+
+    # flanking regions overlapping not allowed regions are not scored
+    excluded = sweep_overlaps(not_allowed_regions_bed, intervals)
+    intervals = [ iv for iv in intervals if iv[3] not in excluded ]
+    flank_scores = sweep_scores(tracks, intervals, stats, threshold)
+
+    no_scores = [["NA"] * len(stats)] * len(tracks)
+    for index, feature in enumerate(features):
+        try:
+            get_track_files(tracks, feature.chrom)
+        except KeyError:
+            print >> output, "Could not find a BED file for %s." % (
+                feature.chrom)
+            continue
+
+        scores_r = flank_scores.get((index, "r"), no_scores)
+        scores_l = flank_scores.get((index, "l"), no_scores)
+        scores = []
+        for score_r, score_l in zip(scores_r, scores_l):
+            scores.extend(combine_flanking_scores(score_r, score_l, stats))
+        s = "\t".join([ str(i) for i in scores ])
+        out = "%s\t%s" % (feature.name, s)
+        print >> output, out
+
+
+def call_sweep_observed_simulation(features, tracks, stats=("mean",),
+                                   threshold=0.0, output=sys.stdout):
+    """
+    Get the observed scores of all features at once, with the same result of
+    call_observed_simulation(), streaming each score BED a single time (see
+    lib.sweep).
+
+    Arg1: features -> BedTool object for all features.
+    Arg2: tracks -> list of dictionaries of chromosome and query BED file
+    names, one per score track.
+    Arg3: stats -> list of aggregations to be calculated for each track.
+    Arg4: threshold -> score threshold used by 'frac_above' aggregation.
+    Arg5: output -> file object where the output is printed.
+
+    Returns -> None. Just prints out the output.
+
+    """
+
+    features = [ Feature(f) for f in features ]
+    intervals = []
+    for index, feature in enumerate(features):
+        try:
+            get_track_files(tracks, feature.chrom)
+        except KeyError:
+            continue
+        intervals.append((feature.chrom, feature.start, feature.end, index))
+    feature_scores = sweep_scores(tracks, intervals, stats, threshold)
+
+    for index, feature in enumerate(features):
+        if index not in feature_scores:
+            print >> output, "Could not find a BED file for %s." % (
+                feature.chrom)
+            continue
+
+        scores = []
+        for track_scores in feature_scores[index]:
+            scores.extend(track_scores)
+        s = "\t".join([ str(i) for i in scores ])
+        out = "%s\t%s" % (feature.name, s)
+        print >> output, out
+
+
+DESCRIPTION = """Performs simulations on 
             phyloP scores (or whatever score) based on  input BED coordinates 
             and querying a BED file containing scores for 
             regions. It is possible to perform two types of simulations.\n
@@ -159,10 +327,24 @@ def main():
             The mean Scores of the flanking regions are then calculated. It is
             possible to pass regions NOT allowed to overlap with the flanking
             region. In this case, the score cannot be computed for a particular
-            feature.
+            feature.\n
+
+            c) Getting the observed scores of the input features themselves.
             
             !Warning: Call this program in an external bash loop to avoid
-            'Too many files open' error.""") 
+            'Too many files open' error, or split the run with the 'plan',
+            'run-shard' and 'merge' subcommands (see 'plan --help')."""
+
+
+def add_simulation_arguments(parser):
+    """
+    Add the arguments defining a simulation run to an argument parser. They
+    are shared by the main program and the 'plan' subcommand.
+
+    Arg1: parser -> An argparse.ArgumentParser object.
+    Returns -> None.
+
+    """
 
     parser.add_argument("-i", dest="features_bed", required=True,
                         help=""""Input file, with features to be simulated.
@@ -170,13 +352,19 @@ def main():
                         by '_'. Ex: feat1_ENSGX_ENSTX... If intragenic names
                         does not follow this pattern scores will be 
                         'NameError1'. This only matters for [-r] option.""")
-    parser.add_argument("-d", dest="dirname_bed", required=True,
+    parser.add_argument("-d", dest="dirname_bed", required=True, nargs="+",
                         help="""Name of the directory where the BED files per
                         chromosome containing scores are stored. File pattern
-                        must be 'chrXX.[...].bed'. *** FILES MUST BE SORTED.""")
-    parser.add_argument("-b", dest="regions_bed", required=True,
+                        must be 'chrXX.[...].bed'. Several directories (score
+                        tracks, e.g. vertebrate, placental and primate phyloP)
+                        can be given, and each interval is scored against all
+                        of them. The output has one column per track, in the
+                        same order of [-d], for each simulation.
+                        *** FILES MUST BE SORTED.""")
+    parser.add_argument("-b", dest="regions_bed", default=None,
                         help="""BED file with regions to be considered for
-                        searching [-r] or to be filtered out [-f | -rf]. If the 
+                        searching [-r] or to be filtered out [-f | -rf].
+                        Required, except for [-obs]. If the 
                         file is gene features (e.g exons or introns), fields 
                         must be separated by '_'. Ex: ENSGX_ENSTX... If names 
                         does not follow this pattern or for some reason, the
@@ -195,6 +383,9 @@ def main():
     simulation_group.add_argument("-rf", "--random_flank", dest="random_flank",
                               action="store_true", help="""Random flanking 
                               simulation, usually for intergenic regions.""")
+    simulation_group.add_argument("-obs", "--observed", dest="observed",
+                              action="store_true", help="""Observed scores of
+                              the input features.""")
 
     parser.add_argument("-n", "--number", dest="number", type=int, default=1,
                         help="""Number of simulations to be performed. Default
@@ -205,44 +396,304 @@ def main():
     parser.add_argument("-wl", "--up_window", dest="window_up", type=int, 
                         default=10000, help="""Upstream window size. 
                         Default = 10000. Only accepted with -r or -rf option.""")
-    
-    args = parser.parse_args()
+    parser.add_argument("-s", "--stat", dest="stats", nargs="+", choices=STATS,
+                        default=["mean"], help="""Aggregations of the scores
+                        in each interval, all computed from the same
+                        extraction: mean, median, max, frac_above (fraction of
+                        bases with score above [-t]) and wmean (mean weighted
+                        by bases covered by the interval). The output has one
+                        column per aggregation, in the given order, for each
+                        track. Default = mean.""")
+    parser.add_argument("-t", "--threshold", dest="threshold", type=float,
+                        default=0.0, help="""Score threshold used by
+                        'frac_above' aggregation. Default = 0.0.""")
+    parser.add_argument("-sw", "--sweep", dest="sweep", action="store_true",
+                        help="""Stream each score BED file (and [-b]) a single
+                        time for all features, instead of querying every
+                        interval with bedextract. Faster for many features.
+                        Only accepted with -f or -obs options.""")
+    parser.add_argument("-cs", "--cache_size", dest="cache_size", type=int,
+                        default=10000, help="""Maximum number of bedextract
+                        results (not allowed regions and scores) kept in
+                        memory, so regions repeated across simulations and
+                        features are extracted only once. 0 disables the
+                        cache. Default = 10000.""")
+
+
+def get_simulation_options(parser, args):
+    """
+    Check the simulation arguments and collect them in a dictionary, which
+    can be stored in shard manifests.
+
+    Arg1: parser -> The argparse.ArgumentParser object used to parse args.
+    Arg2: args -> The parsed arguments.
+    Returns -> A dictionary of simulation options (see shards.plan_shards()).
+
+    """
 
     # checking options
-    if args.flanking == True and args.number != 1:
+    if (args.flanking == True or args.observed == True) and args.number != 1:
         parser.error("-n is only accepted with -r or -rf options.")
-    if (args.flanking == True or args.random == True) and \
+    if (args.flanking == True or args.random == True or
+        args.observed == True) and \
        (args.window_down != 10000 or args.window_up != 10000):
         parser.error("-wr or -wl are only accepted with -rf option.")
+    if args.sweep == True and not (args.flanking == True or
+                                   args.observed == True):
+        parser.error("-sw is only accepted with -f or -obs options.")
+    if args.observed == False and args.regions_bed is None:
+        parser.error("-b is required with -f, -r or -rf options.")
+    if args.cache_size < 0:
+        parser.error("-cs must be 0 or larger.")
+    if args.threshold != 0.0 and "frac_above" not in args.stats:
+        parser.error("-t is only accepted with '-s frac_above'.")
 
-    #-------------------------------#
-    # Call functions and get output #
-    #-------------------------------#
+    if args.flanking:
+        mode = "flanking"
+    elif args.random:
+        mode = "random"
+    elif args.random_flank:
+        mode = "random_flank"
+    elif args.observed:
+        mode = "observed"
+    if args.regions_bed is not None:
+        regions_bed = os.path.abspath(args.regions_bed)
+    else:
+        regions_bed = None
+    options = {"features_bed": os.path.abspath(args.features_bed),
+               "dirname_bed": [ os.path.abspath(d) for d in args.dirname_bed ],
+               "regions_bed": regions_bed,
+               "mode": mode,
+               "sweep": args.sweep,
+               "cache_size": args.cache_size,
+               "number": args.number,
+               "window_down": args.window_down,
+               "window_up": args.window_up,
+               "stats": args.stats,
+               "threshold": args.threshold}
+    return options
+
+
+def prepare_simulation(options):
+    """
+    Read the score tracks and regions used by a simulation run.
 
-    # get features to be tested
-    features = read_features(args.features_bed)
-    bed_files = get_bed_files(args.dirname_bed)
+    Arg1: options -> A dictionary returned by get_simulation_options().
+    Returns -> A tuple (tracks, regions). regions is the dictionary of allowed
+    regions for random simulations, or the not allowed regions BED file name
+    for flanking and random flanking simulations (None for observed scores).
+
+    """
+
+    EXTRACT_CACHE.resize(options.get("cache_size", 10000))
+    tracks = [ get_bed_files(d) for d in options["dirname_bed"] ]
+    if options["mode"] == "random":
+        allowed_regions_bed = read_features(options["regions_bed"])
+        regions = get_regions(allowed_regions_bed)
+    else:
+        regions = options["regions_bed"]
+    return tracks, regions
+
+
+def run_simulation(features, options, tracks, regions, number=1,
+                   output=sys.stdout):
+    """
+    Call the simulation function of the mode chosen in options.
+
+    Arg1: features -> BedTool object (or list of entries) of features.
+    Arg2: options -> A dictionary returned by get_simulation_options().
+    Arg3/4: tracks/regions -> The values returned by prepare_simulation().
+    Arg5: number -> Number of simulations to be performed.
+    Arg6: output -> file object where the output is printed.
+    Returns -> None. Just prints out the output.
+
+    """
 
     # Flanking simulations
-    if args.flanking:
-        not_allowed_regions_bed = args.regions_bed
-        call_flanking_simulation(features, bed_files, not_allowed_regions_bed)
- 
+    if options["mode"] == "flanking" and options.get("sweep"):
+        call_sweep_flanking_simulation(features, tracks, regions,
+                                       stats=options["stats"],
+                                       threshold=options["threshold"],
+                                       output=output)
+    elif options["mode"] == "flanking":
+        call_flanking_simulation(features, tracks, regions,
+                                 stats=options["stats"],
+                                 threshold=options["threshold"],
+                                 output=output)
     # Random simulations
-    elif args.random:
-        allowed_regions_bed = read_features(args.regions_bed)
-        allowed_regions_dict = get_regions(allowed_regions_bed)
-        call_random_intragenic_simulation(features, bed_files,
-                                          allowed_regions_dict,
-                                          number=args.number)
+    elif options["mode"] == "random":
+        call_random_intragenic_simulation(features, tracks, regions,
+                                          number=number,
+                                          stats=options["stats"],
+                                          threshold=options["threshold"],
+                                          output=output)
     # Random flanking simulations
-    elif args.random_flank:
-        not_allowed_regions_bed = args.regions_bed
-        call_random_flanking_simulation(features, bed_files,
-                                        not_allowed_regions_bed,
-                                        number=args.number,
-                                        window_r=args.window_down,
-                                        window_l=args.window_up)
+    elif options["mode"] == "random_flank":
+        call_random_flanking_simulation(features, tracks, regions,
+                                        number=number,
+                                        window_r=options["window_down"],
+                                        window_l=options["window_up"],
+                                        stats=options["stats"],
+                                        threshold=options["threshold"],
+                                        output=output)
+    # Observed scores
+    elif options["mode"] == "observed" and options.get("sweep"):
+        call_sweep_observed_simulation(features, tracks,
+                                       stats=options["stats"],
+                                       threshold=options["threshold"],
+                                       output=output)
+    elif options["mode"] == "observed":
+        call_observed_simulation(features, tracks, stats=options["stats"],
+                                 threshold=options["threshold"],
+                                 output=output)
+
+
+def main_plan(argv):
+    """
+    'plan' subcommand. Split a simulation run into shard manifests.
+
+    """
+
+    parser = argparse.ArgumentParser(prog="simulation_features.py plan",
+            description="""Partition the features x simulations (-n) of a run
+            into -N independent shard manifests (JSON), each one with its
+            random seed, input file hashes and feature offsets. Run each
+            manifest with 'run-shard' (e.g. as a cluster array job) and
+            combine the outputs with 'merge'.""")
+    add_simulation_arguments(parser)
+    parser.add_argument("-N", "--shards", dest="shards", type=int,
+                        required=True, help="Number of shards.")
+    parser.add_argument("-o", "--out_dir", dest="out_dir", required=True,
+                        help="Directory where manifests are written.")
+    parser.add_argument("--seed", dest="seed", type=int, default=None,
+                        help="""Master random seed. Default = random.""")
+    args = parser.parse_args(argv)
+    if args.shards < 1:
+        parser.error("-N must be at least 1.")
+
+    options = get_simulation_options(parser, args)
+    n_features = len(read_features(options["features_bed"]))
+    manifests = plan_shards(options, n_features, args.shards, seed=args.seed)
+    for filename in write_manifests(manifests, args.out_dir):
+        print filename
+
+
+def main_run_shard(argv):
+    """
+    'run-shard' subcommand. Run the simulations of a single shard manifest.
+
+    """
+
+    parser = argparse.ArgumentParser(prog="simulation_features.py run-shard",
+            description="""Run the simulations of a shard manifest created by
+            'plan' and write its output, to be combined by 'merge'.""")
+    parser.add_argument("manifest", help="Shard manifest file.")
+    parser.add_argument("-o", "--output", dest="output", required=True,
+                        help="Shard output file.")
+    parser.add_argument("--cache_stats", dest="cache_stats",
+                        action="store_true", help="""Print cache hits, misses
+                        and hit rate to stderr at the end.""")
+    args = parser.parse_args(argv)
+
+    try:
+        manifest = read_manifest(args.manifest)
+        check_inputs(manifest)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+
+    random.seed(manifest["seed"])
+    options = manifest["options"]
+    features = list(read_features(options["features_bed"]))
+    tracks, regions = prepare_simulation(options)
+
+    lines = []
+    # sweep streams score files once for all features of the shard, which
+    # have a single segment each and one output line per feature.
+    if options.get("sweep"):
+        buf = StringIO()
+        run_simulation([ features[seg[0]] for seg in manifest["segments"] ],
+                       options, tracks, regions, output=buf)
+        outputs = buf.getvalue().splitlines()
+        for segment, out in zip(manifest["segments"], outputs):
+            lines.append(segment_line(segment, out))
+    else:
+        for segment in manifest["segments"]:
+            feature_index, rep_start, rep_end = segment
+            buf = StringIO()
+            run_simulation([features[feature_index]], options, tracks,
+                           regions, number=rep_end - rep_start, output=buf)
+            lines.append(segment_line(segment, buf.getvalue().rstrip("\n")))
+            # remove temporary files of the segment to avoid 'Too many files
+            # open' error
+            cleanup()
+
+    # write to a temporary file, so an interrupted shard leaves no output
+    tmp_output = args.output + ".tmp"
+    with open(tmp_output, "w") as handle:
+        handle.write(shard_header(manifest) + "\n")
+        for line in lines:
+            handle.write(line + "\n")
+        handle.write(shard_footer(lines) + "\n")
+    os.rename(tmp_output, args.output)
+    if args.cache_stats:
+        print >> sys.stderr, EXTRACT_CACHE
+
+
+def main_merge(argv):
+    """
+    'merge' subcommand. Combine shard outputs into the final output.
+
+    """
+
+    parser = argparse.ArgumentParser(prog="simulation_features.py merge",
+            description="""Combine the outputs of all shards of a plan into the
+            final output, in the order of input features, checking that no
+            shard, feature or simulation is missing or duplicated.""")
+    parser.add_argument("outputs", nargs="+", help="Shard output files.")
+    args = parser.parse_args(argv)
+
+    try:
+        lines = merge_shard_outputs(args.outputs)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+    for line in lines:
+        print line
+
+
+SUBCOMMANDS = {"plan": main_plan,
+               "run-shard": main_run_shard,
+               "merge": main_merge}
+
+
+def main():
+    """
+    Get arguments and call functions to perform score simulations on features.
+
+    """
+
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION) 
+    add_simulation_arguments(parser)
+    parser.add_argument("--cache_stats", dest="cache_stats",
+                        action="store_true", help="""Print cache hits, misses
+                        and hit rate to stderr at the end.""")
+    args = parser.parse_args()
+    options = get_simulation_options(parser, args)
+
+    #-------------------------------#
+    # Call functions and get output #
+    #-------------------------------#
+
+    # get features to be tested
+    features = read_features(options["features_bed"])
+    tracks, regions = prepare_simulation(options)
+    run_simulation(features, options, tracks, regions,
+                   number=options["number"])
+    if args.cache_stats:
+        print >> sys.stderr, EXTRACT_CACHE
         
 
 if __name__ == "__main__":